@@ -52,7 +52,7 @@
 # TODO: someday/maybe add a full repl ("creplach"? :-) ) any cloud document by
 #       entering command at the bottom and having the output appear below
 # Optimization TODOs:
-# 1. A large improvement in speed can be found for multiple sequential runs of sweeptext
+# 1. DONE: A large improvement in speed can be found for multiple sequential runs of sweeptext
 # Instead of scanning all source files over again with each pass of sweeptext, 
 # load a list of runs from a '-rulesfile' and scan for all patterns during one pass
 # or, more accurately, two passes. One pass for -refile(s) and a second pass for -collect(s)
@@ -63,10 +63,21 @@
 import sys
 import os
 import shutil
+import time
+import mmap
+import threading
 import argparse
 import shlex
 import re
 import fnmatch
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import hyperscan # optional, finds which rules can match a file with one scan for all of them
+except ImportError:
+    hyperscan=None
+
+mmap_threshold=1<<20 # source files this big are memory mapped instead of read
 
 descriptive_text = """
 Sweeptext scans through text notes like those used by SimpleNote,
@@ -94,7 +105,7 @@ moves (refiles) or copies (collects) those lines to target files.
 
 def main():
     parser=argparse.ArgumentParser( description=descriptive_text, formatter_class=argparse.RawDescriptionHelpFormatter)
-    group = parser.add_mutually_exclusive_group(required=True)
+    group = parser.add_mutually_exclusive_group()
     group.add_argument( '-refile', nargs='?', metavar='pattern', help='Find lines matching pattern, remove them from the source file, insert them into the target file')
     group.add_argument( '-move', nargs='?', metavar='pattern', help='alias for -refile')
     group.add_argument( '-collect', nargs='?', metavar='pattern', help='Find lines matching pattern, copy them to the target file. The target file is wiped and restarted with each run.')
@@ -111,22 +122,73 @@ def main():
     parser.add_argument( '-insert', nargs='?', metavar='location', help="Specified where inserted lines should be placed: 'afterblank', 'top', 'append', 'overwrite'. Note top would be disasterous for Simplenote files because the first line is the title")
     parser.add_argument( '-test', action='store_true', help='run and report on what it would do but don\'t actually change anything')
     parser.add_argument( '-debug', action='store_true', help='print great detail of information, much more than verbose')
+    parser.add_argument( '-j', '-jobs', '--jobs', type=int, metavar='N', default=1, help='number of source files to scan in parallel threads, this can only overlap reading the files (Default 1)')
     parser.add_argument( '-v', '--verbose', action='store_true', help='print what is being done')
     parser.add_argument( '-rulesfile', nargs='?', metavar='filename', help='Specifies a text file containing arguments for multiple batched runs of sweeptext, one run per line')
+    parser.add_argument( '-backups', type=int, metavar='N', default=3, help='number of backups to keep of each changed file, file.swtxt~1 to file.swtxt~N (Default 3)')
     parser.add_argument( '-folder', nargs='?', metavar='foldername', default='.', help='name of the folder to scan (Default "."')
     parser.add_argument( '-from', nargs='?', metavar='filenameglob-or-regex', dest='fromfiles', default='*.txt', help='Specifies the source files to scan. Can contain a glob "*.txt" or regex "[0-9].*\.txt" (Default "*.txt")')
     parser.add_argument( '-exclude', nargs='?', metavar='filenameglob-or-regex', help='Specifies source files to skip. Can contain a glob "*.txt" or regex "[0-9].*\.txt" (Default none)')
-    parser.add_argument( '-to', nargs='?', metavar='filename', required=True, help='Specified the target file(s) to insert matched lines into. Can include a matched word from the match pattern, eg: "collected {tag}.txt"')
+    parser.add_argument( '-to', nargs='?', metavar='filename', help='Specified the target file(s) to insert matched lines into. Can include a matched word from the match pattern, eg: "collected {tag}.txt"')
     args=parser.parse_args()
-    process_args( args)
-    if (args.verbose): print( args)
-    run( args)
+    if args.backups<0:
+        parser.error( '-backups must be 0 or more')
+    if args.jobs<1:
+        parser.error( '-jobs must be 1 or more')
+    if args.test: args.verbose=True
+    if args.debug: args.verbose=True
+    if args.rulesfile:
+        if args.refile or args.move or args.collect or args.copy or args.to:
+            parser.error( '-rulesfile can not be combined with -refile -move -collect -copy or -to, put that rule in the rulesfile')
+        rules=read_rulesfile( parser, args)
+    else:
+        check_args( parser, args)
+        rules=[ args ]
+    for rule in rules:
+        process_args( rule)
+        if (args.verbose): print( rule)
+    run( args, rules)
+
+def check_args( parser, args):
+    # without a -rulesfile the pattern and target are required
+    if not (args.refile or args.move or args.collect or args.copy):
+        parser.error( 'one of the arguments -refile -move -collect -copy is required')
+    if not args.to:
+        parser.error( 'the following arguments are required: -to')
+
+def read_rulesfile( parser, args):
+    # each line of the rulesfile holds the arguments for one run of sweeptext, eg:
+    # sweeptext -refile '^\[{note}\] ' -from "_inbox.txt" -to "{note}.txt"
+    # -folder -test -debug -v -jobs and -backups are taken from the command line and apply to all rules
+    rules=[]
+    try:
+        with open( args.rulesfile, encoding='utf-8') as file:
+            lines=file.readlines()
+    except (OSError, UnicodeDecodeError) as error:
+        parser.error( 'can not read -rulesfile '+args.rulesfile+': '+str(error))
+    for line_num, line in enumerate( lines, 1):
+        if not line.strip() or line.lstrip().startswith('#'):
+            continue # skip blank lines and comments
+        try:
+            try:
+                words=shlex.split( line)
+            except ValueError as error:
+                parser.error( str(error)) # eg: No closing quotation
+            while words and not words[0].startswith('-'):
+                words.pop(0) # skip the leading 'sweeptext' or 'python sweeptext.py'
+            rule=parser.parse_args( words)
+            if rule.rulesfile: parser.error( '-rulesfile can not be used inside a rulesfile')
+            check_args( parser, rule)
+        except SystemExit:
+            print( ' in', args.rulesfile, 'line', line_num, ':', line.strip(), file=sys.stderr)
+            raise
+        for name in ('folder', 'test', 'debug', 'verbose', 'jobs', 'backups'):
+            setattr( rule, name, getattr( args, name))
+        rules.append( rule)
+    return rules
 
 def process_args( args):
 
-    if args.rulesfile:
-        print( ' -rulesfiles has not been implemented yet. Please put batch runs in a script or batch file.', file=sys.stderr)
-        sys.exit(1)
     if args.refile:
         args.action='move'
         args.pattern=args.refile
@@ -159,8 +221,6 @@ def process_args( args):
     if args.addheaders: args.do_addheaders=True
     if args.noaddheaders: args.do_addheaders=False
     if args.insert: args.do_insert=args.insert
-    if args.test: args.verbose=True
-    if args.debug: args.verbose=True
 
 # algorithm:
 # 1. find all matching lines in source files:
@@ -179,140 +239,403 @@ def process_args( args):
 # for all source files updated by -refile removals (not yet swapped)
 #     mv source -> .source.1.old; mv source.sweeptmp -> source
 # (note get file locks on these while they are being updated)
+# With a -rulesfile this is done in two passes, one for all -refile rules and then one for all -collect rules
+# because -refile alters the source files so -collect should be run on the updated source files.
+# Each pass reads every source file once and finds the lines for all of its rules in it, only the lines holding
+# a rule's literal text are split out and searched, each on its own just like reading the file line by line.
+# Within the -refile pass a line is moved by the first rule that matches it (and whose target exists).
 
-    
-def run( args):
-    
-    if args.fromfiles[0]=='/' and args.fromfiles[-1]=='/':
-        source_file_regex = args.fromfiles[1:-1] # cut off slashes, keep regex
+def run( args, rules):
+    # -refile rules first, they change the source files the -collect rules read
+    for action in ('move', 'copy'):
+        pass_rules=[ rule for rule in rules if rule.action==action ]
+        if pass_rules: run_pass( args, pass_rules)
+
+def prepare_rule( rule, dbg):
+    # compile everything a rule needs for scanning, once per run
+    if rule.fromfiles[0]=='/' and rule.fromfiles[-1]=='/':
+        source_file_regex = rule.fromfiles[1:-1] # cut off slashes, keep regex
     else:
-        source_file_regex = fnmatch.translate( args.fromfiles) # convert glob to regex
-    if args.exclude:
-        if args.exclude[0]=='/' and args.exclude[-1]=='/':
-            exclude_file_regex = args.exclude[1:-1] # cut off slashes, keep regex
-            if (args.debug): print('EXCLUDING REGEX ',exclude_file_regex)
+        source_file_regex = fnmatch.translate( rule.fromfiles) # convert glob to regex
+    rule.source_match=re.compile( source_file_regex).match
+    rule.exclude_match=None
+    if rule.exclude:
+        if rule.exclude[0]=='/' and rule.exclude[-1]=='/':
+            exclude_file_regex = rule.exclude[1:-1] # cut off slashes, keep regex
+            dbg('EXCLUDING REGEX ',exclude_file_regex)
         else:
-            exclude_file_regex= fnmatch.translate( args.exclude) # convert glob to regex
-            if (args.debug): print('EXCLUDING GLOB ',args.exclude,' = REGEX ',exclude_file_regex)
+            exclude_file_regex= fnmatch.translate( rule.exclude) # convert glob to regex
+            dbg('EXCLUDING GLOB ',rule.exclude,' = REGEX ',exclude_file_regex)
+        rule.exclude_match=re.compile( exclude_file_regex).match
 
     # handle special pattern syntax {name}, change into regex (?P<name>.*?)\b
-    pattern_regex = re.sub( "{([a-zA-Z]\w*)}", lambda match: '(?P<'+match.group(0)[1:-1]+'>.*?)\\b', args.pattern)
-    if (args.debug): print('pattern_regex=',pattern_regex)
+    pattern_regex = re.sub( "{([a-zA-Z]\w*)}", lambda match: '(?P<'+match.group(0)[1:-1]+'>.*?)\\b', rule.pattern)
+    dbg('pattern_regex=',pattern_regex)
     # must start w a-zA-Z so we don't clobber regex counting operator {n}
-    
-    insert_lines={} # insert_lines[targetnote].append(line)
+    # the pattern is only ever searched for in one line at a time, so ^ $ \s and lookbehinds never see other lines
+    rule.match_pat=re.compile( pattern_regex)
+    # the same pattern without named groups for hyperscan
+    rule.unnamed_regex=re.sub( r"{([a-zA-Z]\w*)}", r'(?:.*?)\\b', rule.pattern)
+    # turn the target filename into a str.format template once: keep the {name} placeholders, escape any other braces
+    to_parts=re.split( r"\{([a-zA-Z]\w*)\}", rule.to) # even indices are literals, odd are names
+    for name in to_parts[1::2]:
+        if name not in rule.match_pat.groupindex:
+            print( ' -to "'+rule.to+'" uses {'+name+'} which is not in the pattern "'+rule.pattern+'"', file=sys.stderr)
+            sys.exit(1)
+    rule.to_template=''.join( part.replace( '{', '{{').replace( '}', '}}') if i%2==0 else '{'+part+'}' for i,part in enumerate(to_parts))
+    # a literal that every match must contain lets us skip files and lines without running the regex at all
+    rule.line_literal=extract_literal( rule.pattern)
+    if '\n' in rule.line_literal: rule.line_literal='' # can't be found within one line
+    rule.literal=rule.line_literal.encode( 'utf-8')
+    dbg('literal=',rule.literal)
+    rule.insert_lines=defaultdict(list) # insert_lines[targetnote].append(line)
     # TODO: if memory gets low, append insert_lines to temp files instead of memory
-    updated_sources=[] # keep track of source files with removed lines
-    doesnt_exist=[] # don't move lines if the target file doesnt exist, track those to avoid lots of stat calls
+    rule.prev_file=None
+
+def run_pass( args, rules):
+    # bind the logging once instead of testing args.verbose and args.debug for every line
+    log=print if args.verbose else lambda *a, **k: None
+    dbg=print if args.debug else lambda *a, **k: None
+    for rule in rules: prepare_rule( rule, dbg)
+
+    def find_lines( buf, rule_nums):
+        # yields the (start, end) of the lines in buf that any of the rules might match:
+        # the lines holding a rule's literal, or every line if one of the rules has no literal
+        literals={ rules[i].line_literal for i in rule_nums }
+        if '' in literals:
+            start=0
+            while start<len(buf):
+                end=buf.find( '\n', start)+1 or len(buf)
+                yield start, end
+                start=end
+            return
+        next_found={ literal: buf.find( literal) for literal in literals } # next position of each literal
+        while True:
+            found=[ pos for pos in next_found.values() if pos>=0 ]
+            if not found:
+                return
+            pos=min( found)
+            start=buf.rfind( '\n', 0, pos)+1
+            end=buf.find( '\n', pos)+1 or len(buf)
+            yield start, end
+            for literal, pos in next_found.items():
+                if 0<=pos<end: next_found[literal]=buf.find( literal, end)
+    def search_line( rule, line):
+        # the rule's pattern searched for in a single line, like reading the file line by line
+        if rule.line_literal and rule.line_literal not in line:
+            return None
+        return rule.match_pat.search( line)
+
+    updated_sources=set() # keep track of source files with removed lines
+    emptied_sources=set() # with -backups 0, the updated sources that had every line removed, truncated without a tmp file
+    # scan the folder once, the DirEntry's cached file type tells us which targets exist without a stat call per target
+    direntries=sorted(os.scandir( args.folder), key=lambda d: d.name.lower())
+    existing_files={ direntry.name for direntry in direntries if direntry.is_file() }
+    target_status={} # target_status[target]=(exists, path). don't move lines if the target file doesnt exist
+    def target_ok( target):
+        status=target_status.get( target)
+        if status is None:
+            path=os.path.join( args.folder, target)
+            # not in our scan: a target in a subfolder, or a name that only matches on case insensitive
+            # or unicode normalizing file systems, eg: [Groceries] -> groceries.txt on Windows and macOS
+            status=( target in existing_files or os.path.exists( path), path)
+            target_status[target]=status
+        return status
+
+    def take_line( rule, pattern_match, line, link_suffix):
+        # found a matching line, returns its target and the text to insert there
+        # calc the target file for it args.to with any {name} substituted
+        target=rule.to_template.format_map( pattern_match.groupdict( '')) # '' for an optional {name} that didn't match
+        if not target_ok( target)[0]:
+            return target, None # if the target doesn't already exist, don't move or copy this line
+        if rule.do_cleanmatch:
+            line=line.replace( pattern_match.group(0), '') # remove matched text - plain text not a regex
+        if rule.do_addlinks:
+            line=line+link_suffix
+        return target, line
+
+    def scan_copy( buf, rule_nums, link_suffix):
+        # -collect: every rule that matches a line gets a copy of it
+        matches=[]
+        for start, end in find_lines( buf, rule_nums):
+            line=buf[start:end]
+            for i in rule_nums:
+                rule=rules[i]
+                pattern_match=search_line( rule, line)
+                if pattern_match:
+                    matches.append( (i,)+take_line( rule, pattern_match, line, link_suffix))
+        return matches, None
+
+    def scan_move( buf, rule_nums, link_suffix):
+        # -refile: the first rule that matches a line (and whose target exists) moves it,
+        # everything between matched lines and any line that wasn't moved stays in the source
+        matches=[]
+        preserved=[]
+        last_end=0
+        for start, end in find_lines( buf, rule_nums):
+            line=buf[start:end]
+            for i in rule_nums:
+                rule=rules[i]
+                pattern_match=search_line( rule, line)
+                if pattern_match:
+                    target, moved=take_line( rule, pattern_match, line, link_suffix)
+                    matches.append( (i, target, moved))
+                    if moved is not None:
+                        preserved.append( buf[last_end:start])
+                        last_end=end
+                        break # a line can only be moved once
+        if last_end==0:
+            return matches, None # nothing was moved, leave the source alone
+        preserved.append( buf[last_end:])
+        return matches, ''.join( preserved)
+
+    def scan_file( source):
+        # runs in a worker thread: find all matching lines in one source file
+        # returns the matches as [(rule, target, line)], line is None if the target doesnt exist,
+        # and for -refile the text that stays in the source file (None if nothing was moved)
+        direntry, rule_nums=source
+        link_suffix=' ['+os.path.splitext(direntry.name)[0]+']'
+        with open( os.path.join( args.folder, direntry.name), mode='rb') as file:
+            # map large files instead of reading them, so the literal check only pages in what it needs
+            # and the text is decoded straight from the mapping without another copy
+            large=os.fstat( file.fileno()).st_size>=mmap_threshold
+            raw=mmap.mmap( file.fileno(), 0, access=mmap.ACCESS_READ) if large else file.read()
+        try:
+            rule_nums=tuple( i for i in rule_nums if not rules[i].literal or raw.find( rules[i].literal)>=0)
+            if rule_nums and hs_db and raw.find( b'\r')<0: # hyperscan sees the raw bytes, without newline translation
+                found=set()
+                hs_db.scan( raw, match_event_handler=lambda i, *a: found.add( i), scratch=hs_scratch())
+                rule_nums=tuple( i for i in rule_nums if i not in hs_rules or i in found)
+            if not rule_nums:
+                return [], None # nothing can match, leave the file alone
+            buf=decode_text( raw)
+        finally:
+            if large: raw.close()
+        return scan( buf, rule_nums, link_suffix)
+    scan=scan_move if rules[0].action=='move' else scan_copy # all rules in a pass have the same action
+
+    hs_db, hs_rules=build_hyperscan( rules) if hyperscan else (None, set())
+    if hs_db: dbg('hyperscan prefilters rules ',sorted( hs_rules))
+    hs_local=threading.local()
+    def hs_scratch():
+        # hyperscan needs its own scratch space in each worker thread
+        if not hasattr( hs_local, 'scratch'): hs_local.scratch=hyperscan.Scratch( hs_db)
+        return hs_local.scratch
 
     # find all matching lines in source files:
-    prev_file=None
-    for direntry in sorted(os.scandir( args.folder), key=lambda d: d.name.lower()):
-        if not re.match( source_file_regex, direntry.name):
-            continue # skip files that don't match the FROM pattern
-        if args.exclude and re.match( exclude_file_regex, direntry.name):
-            if (args.verbose): print("SKIP ",direntry.name)
-            continue # skip files that match the EXCLUDE pattern
+    sources=[] # [(direntry, numbers of the rules that read this file)]
+    for direntry in direntries:
         if direntry.name.endswith('.old'):
             continue # skip sweeptext backup files
-        if args.verbose: print('Reading ',direntry.name)
-        
-        with open( os.path.join( args.folder, direntry.name), encoding='utf-8') as file:
-            updated_tmpfile=False
-            for line in file:
-                pattern_match=re.search( pattern_regex, line)
-                # if the pattern matches and the target file exists, move or copy it to the target
-                # if we are in move mode and (the pattern doesnt match or the target file doesnt exist), copy the line (preserve) to the temp file
-                if pattern_match:
-                    # found a matching line
-                    # calc the target file for it args.to with any {name} substituted
-                    # get the {name} in args.to, lookup the corresponding named group on the line in pattern_match
-                    target=re.sub( "{([a-zA-Z]\w*)}", lambda sub_match: pattern_match.group(sub_match.group(0)[1:-1]), args.to)
-                    if target in doesnt_exist or not os.path.exists( os.path.join( args.folder, target)):
-                        # if the target doesn't already exist, don't move or copy this line
-                        if args.verbose: print('  ',target,' does not exist, skipping line')
-                        doesnt_exist.append( target)
-                    else: # target file exists
-                        if args.do_cleanmatch:
-                            line=line.replace( pattern_match.group(0), '') # remove matched text - plain text not a regex
-                        if args.do_addlinks:
-                            line=line+' ['+os.path.splitext(direntry.name)[0]+']'
-                        if args.do_addheaders and prev_file!=direntry.name:
-                            additem( insert_lines, target, '\n['+os.path.splitext(direntry.name)[0]+']\n')
-                            prev_file=direntry.name
-                            if (args.debug): print( '  TO: ',target, ' Header : ['+os.path.splitext(direntry.name)[0]+']')
-                        additem( insert_lines, target, line)
-                        if args.debug: print( '  TO: ',target,line, end='')
-                if args.action=='move' and (not pattern_match or target in doesnt_exist or not os.path.exists( os.path.join( args.folder, target))):
-                    # if we are in move mode and (the pattern doesnt match or the target file doesnt exist), copy the line (preserve) to the temp file
-                    # remove matched lines by copying unmatched lines to tmp file
-                    if not updated_tmpfile:
-                        source_tmpfile = open( os.path.join( args.folder, direntry.name+'.swtxttmp'), encoding='utf-8', mode='w')
-                        updated_tmpfile=True
-                        updated_sources.append( direntry.name)
-                    print( line, file=source_tmpfile, end='')
-        if updated_tmpfile:
-            source_tmpfile.close()
-    # insert all matched lines in their targets
-    for target in insert_lines:
-        if args.verbose: print('Writing to ',target)
-        if target in updated_sources:
-            # if the target has been updated by -refile, first apply any updates
-            if not args.test: apply_file_update( target, args.folder)
-            updated_sources.remove( target)
-        if args.do_insert=='top':
-            # insert the matched lines to the TOP of target
-            # first copy matched lines, then original contents of target
-            with open( os.path.join( args.folder, target)+'.swtxttmp', encoding='utf-8', mode='w') as tempfile:
-                tempfile.writelines( insert_lines[target])
-                with open( os.path.join( args.folder, target), encoding='utf-8') as targetfile:
-                    shutil.copyfileobj( targetfile, tempfile)
-        if args.do_insert=='append':
-            # insert the matched lines to the BOTTOM of target
-            # first copy the original contents of target, then append the matched lines
-            shutil.copy( os.path.join( args.folder, target), os.path.join( args.folder, target)+'.swtxttmp')
-            with open( os.path.join( args.folder, target)+'.swtxttmp', encoding='utf-8', mode='a') as tempfile:
-                tempfile.writelines( insert_lines[target])
-        if args.do_insert=='overwrite':
-            # overwrite the file with the matched lines
-            with open( os.path.join( args.folder, target)+'.swtxttmp', encoding='utf-8', mode='w') as tempfile:
-                tempfile.writelines( insert_lines[target])
-        if args.do_insert=='afterblank':
-            # insert the matched lines IN THE MIDDLE of target, after the first blank line
-            # first copy the top of the original file, then the matched lines, then the rest of the original file
-            inserted_lines=False
-            with open( os.path.join( args.folder, target)+'.swtxttmp', encoding='utf-8', mode='w') as tempfile:
-                with open( os.path.join( args.folder, target), encoding='utf-8') as targetfile:
-                    for line in targetfile:
-                        if line=='\n' and not inserted_lines:
-                            print( line, file=tempfile, end='') # blank before and after inserted lines
-                            tempfile.writelines( insert_lines[target])
-                            inserted_lines=True
-                        print( line, file=tempfile, end='')
-                    if not inserted_lines: # empty file, or no blank lines: append
-                        tempfile.writelines( insert_lines[target])
-        if args.verbose: sys.stdout.writelines( ['  '+s for s in insert_lines[target]])
-        # replace the target file with the new updated version
-        if not args.test: apply_file_update( target, args.folder)
+        rule_nums=[]
+        for i, rule in enumerate( rules):
+            if not rule.source_match( direntry.name):
+                continue # skip files that don't match the FROM pattern
+            if rule.exclude_match and rule.exclude_match( direntry.name):
+                log("SKIP ",direntry.name)
+                continue # skip files that match the EXCLUDE pattern
+            rule_nums.append( i)
+        if rule_nums: sources.append( (direntry, tuple( rule_nums)))
+    # scan the source files in parallel with -jobs, but collect the results in source file order
+    with ThreadPoolExecutor( max_workers=args.jobs) as executor:
+        for (direntry, rule_nums), (matches, preserved) in zip( sources, executor.map( scan_file, sources)):
+            log('Reading ',direntry.name)
+            header='\n['+os.path.splitext(direntry.name)[0]+']\n'
+            for i, target, line in matches:
+                rule=rules[i]
+                if line is None:
+                    log('  ',target,' does not exist, skipping line')
+                    continue
+                if rule.do_addheaders and rule.prev_file!=direntry.name:
+                    rule.insert_lines[target].append( header)
+                    rule.prev_file=direntry.name
+                    dbg( '  TO: ',target, ' Header : '+header.strip())
+                rule.insert_lines[target].append( line)
+                dbg( '  TO: ',target,line, end='')
+            if preserved=='' and args.backups==0:
+                # nothing stays and no backup is kept, so the source is truncated in place later
+                # (with backups it is renamed to the backup, that still needs an empty tmp file in its place)
+                emptied_sources.add( direntry.name)
+                updated_sources.add( direntry.name)
+            elif preserved is not None:
+                # remove matched lines by writing everything else to a tmp file in one go
+                with open( os.path.join( args.folder, direntry.name+'.swtxttmp'), mode='wb') as source_tmpfile:
+                    source_tmpfile.write( encode_text( preserved))
+                updated_sources.add( direntry.name)
+    # insert all matched lines in their targets, rule by rule
+    for rule in rules:
+        insert_lines=rule.insert_lines
+        for target in insert_lines:
+            log('Writing to ',target)
+            target_path=target_status[target][1]
+            inserted_text=''.join( insert_lines[target]) # encoded only by the branches that write it as is
+            if target in updated_sources:
+                # if the target has been updated by -refile, first apply any updates
+                if not args.test: apply_file_update( target, args.folder, args.backups, target in emptied_sources)
+                updated_sources.discard( target)
+            if rule.do_insert=='top':
+                # insert the matched lines to the TOP of target
+                # first copy matched lines, then original contents of target
+                with open( target_path+'.swtxttmp', mode='wb') as tempfile:
+                    tempfile.write( encode_text( inserted_text))
+                    with open( target_path, mode='rb') as targetfile:
+                        copy_rest( targetfile, tempfile)
+            if rule.do_insert=='append':
+                # insert the matched lines to the BOTTOM of target
+                # first copy the original contents of target, then append the matched lines
+                shutil.copyfile( target_path, target_path+'.swtxttmp') # uses sendfile etc where available
+                with open( target_path+'.swtxttmp', mode='ab') as tempfile:
+                    tempfile.write( encode_text( inserted_text))
+            if rule.do_insert=='overwrite':
+                # overwrite the file with the matched lines
+                with open( target_path+'.swtxttmp', mode='wb') as tempfile:
+                    tempfile.write( encode_text( inserted_text))
+            if rule.do_insert=='afterblank':
+                # insert the matched lines IN THE MIDDLE of target, after the first blank line
+                # first copy the top of the original file, then the matched lines, then the rest of the original file
+                with open( target_path, mode='rb') as targetfile:
+                    buf=decode_text( targetfile.read())
+                # find the start of the first blank line
+                if buf.startswith('\n'):
+                    blank=0
+                else:
+                    blank=buf.find('\n\n')
+                    if blank>=0: blank+=1
+                if blank>=0:
+                    buf=buf[:blank]+'\n'+inserted_text+buf[blank:] # blank before and after inserted lines
+                else: # empty file, or no blank lines: append
+                    buf=buf+inserted_text
+                with open( target_path+'.swtxttmp', mode='wb') as tempfile:
+                    tempfile.write( encode_text( buf))
+            if args.verbose: sys.stdout.writelines( ['  '+s for s in insert_lines[target]])
+            # replace the target file with the new updated version
+            if not args.test: apply_file_update( target, args.folder, args.backups)
 
     # finally, for all sources that were updated with removed -refile lines, apply the updates
     if not args.test:
         for target in updated_sources:
-            apply_file_update( target, args.folder)
+            apply_file_update( target, args.folder, args.backups, target in emptied_sources)
 
-def additem( list, index, item):
-    if index in list:
-        list[index].append(item)
-    else:
-        list[index]=[ item ]
-        
-def apply_file_update( file, folder):
+def build_hyperscan( rules):
+    # compile the rules into one hyperscan database in prefilter mode, which reports a superset of the real matches
+    # returns the database and the numbers of the rules in it, rules hyperscan can't handle are left out
+    # rules with inline flags are left out too, eg: hyperscan doesn't fold case like python does for non-ascii text
+    # and so are rules with anchors or assertions that mean something else in a whole file than in one line,
+    # eg: \A is the start of every line to us but only the start of the file to hyperscan
+    flags=hyperscan.HS_FLAG_PREFILTER|hyperscan.HS_FLAG_MULTILINE|hyperscan.HS_FLAG_UTF8|hyperscan.HS_FLAG_UCP|hyperscan.HS_FLAG_SINGLEMATCH|hyperscan.HS_FLAG_ALLOWEMPTY
+    expressions={}
+    for i, rule in enumerate( rules):
+        if re.search( r'\(\?[aiLmsux]', rule.pattern):
+            continue
+        if re.search( r'\\[AZB]|\$|\(\?<?!', rule.pattern):
+            continue
+        expression=rule.unnamed_regex.encode( 'utf-8')
+        try:
+            hyperscan.Database().compile( expressions=[ expression ], ids=[ i ], elements=1, flags=flags)
+        except hyperscan.error:
+            continue
+        expressions[i]=expression
+    if not expressions:
+        return None, set()
+    hs_db=hyperscan.Database()
+    hs_db.compile( expressions=list( expressions.values()), ids=list( expressions), elements=len(expressions), flags=flags)
+    return hs_db, set( expressions)
+
+def extract_literal( pattern):
+    # find the longest run of plain characters that any match of pattern must contain, '' if we can't tell
+    # only looks outside of groups and character classes, and gives up on alternation and inline flags
+    if '|' in pattern or pattern.startswith('(?'): return ''
+    longest=''
+    run=''
+    depth=0
+    i=0
+    while i<len(pattern):
+        c=pattern[i]
+        if c=='\\' and i+1<len(pattern) and not pattern[i+1].isalnum():
+            c=pattern[i+1] # escaped metachar, eg: \[ is a literal [
+            i+=1
+        elif c in '*?' or (c=='{' and not re.match( r'{[a-zA-Z]\w*}', pattern[i:])):
+            run=run[:-1] # the previous char is optional
+            if c=='{': i=pattern.find( '}', i) if '}' in pattern[i:] else len(pattern)
+            c=None
+        elif c=='[':
+            match=re.match( r'\[\^?\]?(?:\\.|[^\]\\])*\]', pattern[i:]) # skip the character class
+            i+=len( match.group(0))-1 if match else len(pattern)
+            c=None
+        elif c=='{':
+            i=pattern.find( '}', i) # {name} placeholder
+            c=None
+        elif c=='\\':
+            if i+1<len(pattern) and (pattern[i+1] in 'xuUN' or pattern[i+1].isdigit()): return '' # numeric escapes, don't bother
+            i+=1 # special sequence, eg: \b \w
+            c=None
+        elif c in '.^$+()':
+            if c=='(': depth+=1
+            if c==')': depth-=1
+            c=None
+        if c is None or depth>0:
+            if len(run)>len(longest): longest=run
+            run=''
+        else:
+            run+=c
+        i+=1
+    if len(run)>len(longest): longest=run
+    return longest
+
+def decode_text( raw):
+    # we read source files in binary to check for the literal first, so do TextIOWrapper's newline translation ourselves
+    text=str( raw, 'utf-8') # raw can be bytes or an mmap
+    if '\r' in text: text=text.replace( '\r\n', '\n').replace( '\r', '\n')
+    return text
+
+def encode_text( text):
+    # we write tmp files in binary to skip TextIOWrapper, so do its newline translation ourselves
+    if os.linesep!='\n': text=text.replace( '\n', os.linesep)
+    return text.encode( 'utf-8')
+
+def copy_rest( src, dst):
+    # copies the rest of the binary file src to the end of dst, inside the kernel with sendfile where we can
+    dst.flush()
+    start=offset=src.tell()
+    size=os.fstat( src.fileno()).st_size
+    try:
+        while offset<size:
+            sent=os.sendfile( dst.fileno(), src.fileno(), offset, size-offset)
+            if sent==0: break
+            offset+=sent
+    except (AttributeError, OSError): # no sendfile on Windows, and only to sockets on macOS
+        if offset!=start: raise
+        shutil.copyfileobj( src, dst)
+        return
+    src.seek( offset)
+    dst.seek( 0, os.SEEK_END)
+
+def apply_file_update( file, folder, backups, emptied=False):
     # applies changes in a temp file to the original file, with backups
+    # an emptied file (only with -backups 0) has no temp file, it is truncated in place
     path=os.path.join( folder, file)
-    if (os.path.exists( path+'.swtxt~2')): os.replace( path+'.swtxt~2', path+'.swtxt~3')
-    if (os.path.exists( path+'.swtxt~1')): os.rename( path+'.swtxt~1', path+'.swtxt~2')
-    os.rename( path, path+'.swtxt~1')
-    os.rename( path+'.swtxttmp', path)
+    if emptied:
+        os.truncate( path, 0)
+        return
+    for i in range( backups-1, 0, -1):
+        try:
+            replace_file( path+'.swtxt~'+str(i), path+'.swtxt~'+str(i+1))
+        except FileNotFoundError:
+            pass # no backup this old yet, cheaper than a stat call first
+    if backups>0: replace_file( path, path+'.swtxt~1')
+    replace_file( path+'.swtxttmp', path)
+
+def replace_file( src, dst):
+    # os.replace, but retry a few times: Dropbox etc can hold a file for a moment while they sync it
+    for attempt in range(3):
+        try:
+            os.replace( src, dst)
+            return
+        except FileNotFoundError:
+            raise
+        except OSError:
+            if attempt==2: raise
+            time.sleep( 0.05*2**attempt)
 
 if __name__=='__main__':
     main()